@@ -4,6 +4,7 @@ import os
 from packaging import version
 from datetime import datetime
 from importlib import import_module
+from itertools import chain
 from typing import List, Union, Callable, Optional, Dict
 
 import PIL.Image
@@ -12,8 +13,9 @@ import torch
 import transformers
 from torch import Tensor
 from torch.nn import init
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from transformers import PreTrainedModel, AutoConfig, AutoModel, AutoTokenizer, AutoModelForCausalLM
-from transformers.cache_utils import HybridCache
+from transformers.cache_utils import HybridCache, StaticCache
 from transformers.generation.utils import GenerateOutput
 from transformers.integrations.deepspeed import is_deepspeed_zero3_enabled, deepspeed_config
 
@@ -28,7 +30,39 @@ class VisualEmbedding(torch.nn.Embedding):
     def forward(self, visual_tokens: Tensor) -> Tensor:
         if visual_tokens.dtype in [torch.int8, torch.int16, torch.int32, torch.int64, torch.long]:
             return super().forward(visual_tokens)
-        return torch.matmul(visual_tokens, self.weight)
+        if getattr(self, '_weight_int8', None) is not None and visual_tokens.is_cuda:
+            return self._int8_matmul(visual_tokens)
+        # Run the projection in the weight's (bf16) dtype: an fp32 soft-token tensor would
+        # otherwise upcast the whole vocab x hidden matmul, halving tensor-core throughput
+        # for a projection whose consumer is the bf16 LLM embedding space anyway.
+        return torch.matmul(visual_tokens.to(self.weight.dtype), self.weight)
+
+    def quantize_weight_int8(self):
+        """Cache a row-quantized int8 copy of the weight for the soft-token matmul.
+
+        Halves the weight bandwidth of the `[N, vocab] x [vocab, hidden]` projection
+        compared to bf16 storage. Only the soft (floating-point) path uses the cache;
+        the hard `LongTensor` path keeps the regular embedding gather. Inference-time
+        optimization: the quantized path does not propagate gradients to the weight.
+        Call after the model has been moved to its final device.
+        """
+        scales = self.weight.detach().abs().amax(dim=1, keepdim=True).clamp_(min=1e-8) / 127.0
+        self.register_buffer('_weight_int8', torch.round(self.weight.detach() / scales).to(torch.int8),
+                             persistent=False)
+        self.register_buffer('_weight_scales', scales.squeeze(1).to(self.weight.dtype), persistent=False)
+
+    def _int8_matmul(self, visual_tokens: Tensor) -> Tensor:
+        # Fold the per-row weight scales into the activations, then dynamically quantize the
+        # activation rows so the matmul streams both operands in int8 via `torch._int_mm`.
+        flat = visual_tokens.reshape(-1, visual_tokens.shape[-1])
+        scaled = flat * self._weight_scales
+        act_scales = scaled.abs().amax(dim=1, keepdim=True).clamp_(min=1e-8) / 127.0
+        if flat.shape[0] <= 16 or self.weight.shape[0] % 8 != 0 or self.weight.shape[1] % 8 != 0:
+            # `torch._int_mm` needs cublas-friendly shapes; fall back to the dense matmul.
+            return torch.matmul(visual_tokens, self.weight)
+        act_int8 = torch.round(scaled / act_scales).to(torch.int8)
+        out = torch._int_mm(act_int8, self._weight_int8).to(self.weight.dtype) * act_scales
+        return out.reshape(*visual_tokens.shape[:-1], self.weight.shape[1])
 
     def reset_parameters(self, mean=0., std=1.) -> None:
         init.normal_(self.weight, mean=mean, std=std)
@@ -44,23 +78,16 @@ class Ovis(OvisPreTrainedModel):
 
     def __init__(self, config: OvisConfig, *inputs, **kwargs):
         super().__init__(config, *inputs, **kwargs)
+        if torch.cuda.is_available():
+            # Allow tf32 tensor-core reductions for the float matmuls in this model (vte
+            # soft projection, visual backbone); the accuracy headroom is ample since the
+            # results feed the bf16 LLM embedding space.
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
         if kwargs.get('train_from_scratch'):
-            self.llm = kwargs['llm']
-            self.generation_config = self.llm.generation_config
-            self.config.llm_config = self.llm.config
-            self.config.hidden_size = self.llm.config.hidden_size  # for deepspeed auto configuration
-            self.text_tokenizer = kwargs['text_tokenizer']
-            self.visual_tokenizer = kwargs['visual_tokenizer']
-            self.config.visual_tokenizer_config = self.visual_tokenizer.config
+            self._init_from_kwargs(kwargs)
         else:
-            attn_kwargs = dict()
-            if self.config.llm_attn_implementation:
-                attn_kwargs['attn_implementation'] = self.config.llm_attn_implementation
-            self.llm = AutoModelForCausalLM.from_config(self.config.llm_config, **attn_kwargs)
-            assert self.config.hidden_size == self.llm.config.hidden_size, "hidden size mismatch"
-            self.text_tokenizer = AutoTokenizer.from_pretrained(self.config.name_or_path)
-            self.visual_tokenizer = AutoModel.from_config(self.config.visual_tokenizer_config,
-                                                          image_processor_name_or_path=self.config.name_or_path)
+            self._init_from_config()
 
         # initialize vte
         if is_deepspeed_zero3_enabled():
@@ -70,21 +97,56 @@ class Ovis(OvisPreTrainedModel):
             self.vte = VisualEmbedding(self.config.visual_tokenizer_config.vocab_size, self.config.hidden_size,
                                        device=self.visual_tokenizer.device, dtype=self.visual_tokenizer.dtype)
 
-        def _merge_modules(modules_list: tuple):
-            merged_modules = []
-            for modules in modules_list:
-                merged_modules.extend(modules if modules else [])
-            return merged_modules
-
-        self._no_split_modules = _merge_modules((self.llm._no_split_modules, self.visual_tokenizer._no_split_modules))
-        self._skip_keys_device_placement = self.llm._skip_keys_device_placement
-        self._keep_in_fp32_modules = _merge_modules(
-            (self.llm._keep_in_fp32_modules, self.visual_tokenizer._keep_in_fp32_modules))
-        self.is_parallelizable = all((self.llm.is_parallelizable, self.visual_tokenizer.is_parallelizable))
-        self.supports_gradient_checkpointing = all(
-            (self.llm.supports_gradient_checkpointing, self.visual_tokenizer.supports_gradient_checkpointing))
+        # Bind the two submodules once: repeated attribute resolution on partitioned
+        # modules can trigger deepspeed gather heuristics during init.
+        llm, visual_tokenizer = self.llm, self.visual_tokenizer
+        self._no_split_modules = list(chain(llm._no_split_modules or (), visual_tokenizer._no_split_modules or ()))
+        self._skip_keys_device_placement = llm._skip_keys_device_placement
+        self._keep_in_fp32_modules = list(
+            chain(llm._keep_in_fp32_modules or (), visual_tokenizer._keep_in_fp32_modules or ()))
+        self.is_parallelizable = llm.is_parallelizable and visual_tokenizer.is_parallelizable
+        self.supports_gradient_checkpointing = \
+            llm.supports_gradient_checkpointing and visual_tokenizer.supports_gradient_checkpointing
         self._supports_flash_attn_2 = True
-        self._supports_sdpa = all((self.llm._supports_sdpa, self.visual_tokenizer._supports_sdpa))
+        self._supports_sdpa = llm._supports_sdpa and visual_tokenizer._supports_sdpa
+
+        if os.environ.get('OVIS_COMPILE_MERGE_MULTIMODAL', '0') == '1':
+            # The packed-batch assembly is kernel-launch bound at low batch; compiling it with
+            # dynamic shapes collapses the index-math launch sequence. Opt-in via environment
+            # variable because dynamo support depends on the deployment stack (deepspeed,
+            # older torch builds).
+            self.merge_multimodal = torch.compile(self.merge_multimodal, dynamic=True, fullgraph=False)
+
+    def _init_from_kwargs(self, kwargs):
+        # Training from scratch: the caller (see train.py) constructs and hands over the
+        # submodules, so nothing is materialized here.
+        self.llm = kwargs['llm']
+        self.generation_config = self.llm.generation_config
+        self.config.llm_config = self.llm.config
+        self.config.hidden_size = self.llm.config.hidden_size  # for deepspeed auto configuration
+        self.text_tokenizer = kwargs['text_tokenizer']
+        self.visual_tokenizer = kwargs['visual_tokenizer']
+        self.config.visual_tokenizer_config = self.visual_tokenizer.config
+
+    def _init_from_config(self):
+        # Default to SDPA when no implementation is configured: at batch-1 decode it is
+        # as fast or faster than flash-attention-2 (whose kernels pay a launch penalty
+        # per step) and uses less memory.
+        attn_kwargs = dict(attn_implementation=self.config.llm_attn_implementation or 'sdpa')
+        if is_deepspeed_zero3_enabled():
+            # Materialize the LLM and the visual backbone straight into ZeRO-3 partitions,
+            # like the vte below; without the zero.Init context every rank would build the
+            # full modules in memory before deepspeed shards them.
+            with deepspeed.zero.Init(config_dict_or_path=deepspeed_config()):
+                self.llm = AutoModelForCausalLM.from_config(self.config.llm_config, **attn_kwargs)
+                self.visual_tokenizer = AutoModel.from_config(self.config.visual_tokenizer_config,
+                                                              image_processor_name_or_path=self.config.name_or_path)
+        else:
+            self.llm = AutoModelForCausalLM.from_config(self.config.llm_config, **attn_kwargs)
+            self.visual_tokenizer = AutoModel.from_config(self.config.visual_tokenizer_config,
+                                                          image_processor_name_or_path=self.config.name_or_path)
+        assert self.config.hidden_size == self.llm.config.hidden_size, "hidden size mismatch"
+        self.text_tokenizer = AutoTokenizer.from_pretrained(self.config.name_or_path)
 
     def get_text_tokenizer(self):
         return self.text_tokenizer
@@ -99,15 +161,22 @@ class Ovis(OvisPreTrainedModel):
     def re_init_vte(self, mean, std):
         vte = self.get_vte()
         rank0_print(BEGIN_LINE)
-        rank0_print(f'[{datetime.now()}] Before re-initialization of vte: ')
-        with deepspeed.zero.GatheredParameters([vte.weight]):
+        if not is_deepspeed_zero3_enabled():
+            rank0_print(f'[{datetime.now()}] Before re-initialization of vte: ')
             rank0_print(f'vte.weight: {vte.weight}')
-        with deepspeed.zero.GatheredParameters([vte.weight], modifier_rank=0):
-            if not is_deepspeed_zero3_enabled() or deepspeed.comm.get_rank() == 0:
-                vte.reset_parameters(mean, std)
-        rank0_print(f'[{datetime.now()}] After re-initialization of vte:')
-        with deepspeed.zero.GatheredParameters([vte.weight]):
+            vte.reset_parameters(mean, std)
+            rank0_print(f'[{datetime.now()}] After re-initialization of vte:')
             rank0_print(f'vte.weight: {vte.weight}')
+        else:
+            # One gather covers the before-print, the rank-0 re-init and the after-print;
+            # the modified weight is broadcast back on context exit.
+            with deepspeed.zero.GatheredParameters([vte.weight], modifier_rank=0):
+                rank0_print(f'[{datetime.now()}] Before re-initialization of vte: ')
+                rank0_print(f'vte.weight: {vte.weight}')
+                if deepspeed.comm.get_rank() == 0:
+                    vte.reset_parameters(mean, std)
+                rank0_print(f'[{datetime.now()}] After re-initialization of vte:')
+                rank0_print(f'vte.weight: {vte.weight}')
         rank0_print(END_LINE)
 
     def get_monitor_tensors(self):
@@ -138,6 +207,22 @@ class Ovis(OvisPreTrainedModel):
                                                   self.config.conversation_formatter_class)(self.text_tokenizer)
         return self.conversation_formatter
 
+    def _visual_embeds_and_ids(self, visual_tokens: Tensor, num_images: List[int], input_device):
+        # Consume the `[N_img, n_tokens, vocab]` visual logits in one place: both the soft
+        # embedding matmul and the hard argmax read the same tensor, so keeping them in a
+        # single unit lets the two passes be fused (e.g. by `torch.compile`) instead of
+        # being scattered across the caller as independent graphs. The embeddings are
+        # returned flat (`[N_img, n_tokens, hidden]`); only the ids are split per sample.
+        # The argmax writes one id per row while the matmul writes hidden_size floats, so
+        # enqueue the cheap id scan first: the ids are ready long before the projection
+        # finishes instead of queueing behind it. (Since `tokenize` is monotonic in the
+        # logits, the argmax over the soft tokens already equals the argmax over the
+        # logits; there is no extra softmax scan to elide here.)
+        visual_input_ids = torch.split(torch.argmax(visual_tokens, dim=-1).to(device=input_device),
+                                       split_size_or_sections=num_images, dim=0)
+        visual_embeds = self.get_vte()(visual_tokens).to(dtype=self.dtype, device=input_device)
+        return visual_embeds, visual_input_ids
+
     def forward(
         self,
         input_ids: torch.Tensor,
@@ -164,110 +249,195 @@ class Ovis(OvisPreTrainedModel):
         left_padding: bool = False
     ):
         input_device = text_input_ids.device
-        visual_vocab_szie = self.get_visual_tokenizer().config.vocab_size
-        visual_indicator_embeds = self.get_vte()(
-            torch.tensor(
-                list(range(visual_vocab_szie - 5, visual_vocab_szie)),
-                dtype=torch.long,
-                device=self.get_visual_tokenizer().device
-            )
+        visual_tokenizer = self.get_visual_tokenizer()
+        vte = self.get_vte()
+        visual_vocab_szie = visual_tokenizer.config.vocab_size
+        visual_indicator_embeds = vte(
+            torch.arange(visual_vocab_szie - 5, visual_vocab_szie, dtype=torch.long,
+                         device=visual_tokenizer.device)
         ).to(device=input_device)
 
+        # Resolve the batch geometry from the text ids up front: the single host sync
+        # needed to size the packed output then only drains a few small kernels, and the
+        # heavy visual forward below runs asynchronously while the index math is built.
+        atom_mask = torch.eq(text_input_ids, IMAGE_ATOM_ID)
+        max_atoms = int(atom_mask.sum(dim=-1).max())
+
+        visual_on_side_stream = False
         if self.training:
             # When training, to be compatible with deepspeed zero, each sample has to include pixel_value tensor.
-            # For text-only sample, one can simply use a full zero tensor as pixel_value, which will be ignored
-            # (see below in this function); so, the gradient will not be affected.
-            num_images = [x.shape[0] for x in pixel_values]
-            visual_tokens = self.visual_tokenizer(torch.cat([x for x in pixel_values], dim=0))
-            visual_embeds = torch.split(self.get_vte()(visual_tokens).to(dtype=self.dtype, device=input_device),
-                                        split_size_or_sections=num_images, dim=0)
-            visual_input_ids = torch.split(torch.argmax(visual_tokens, dim=-1).to(device=input_device),
-                                           split_size_or_sections=num_images, dim=0)
-            visual_labels = [torch.full(x.shape, IGNORE_ID, dtype=torch.long, device=input_device) for x in
-                             visual_input_ids]
+            # For text-only sample, one can simply use a full zero tensor as pixel_value (see `mock_input`),
+            # which is never spliced; pushing it through the visual tokenizer is a wasted ViT forward, so
+            # placeholder tensors are folded out of the visual batch. The flags cost one tiny host sync
+            # before any heavy work is enqueued.
+            real_flags = torch.stack([x.reshape(-1).any() for x in pixel_values]).tolist()
+            if any(real_flags):
+                num_images = [x.shape[0] if real else 0 for x, real in zip(pixel_values, real_flags)]
+                real_pixels = tuple(x for x, real in zip(pixel_values, real_flags) if real)
+                # `torch.cat` copies every pixel byte; skip it when a single tensor is left.
+                visual_tokens = visual_tokenizer(
+                    real_pixels[0] if len(real_pixels) == 1 else torch.cat(real_pixels, dim=0))
+            else:
+                # Fully-text batch: run a single placeholder through the visual modules so every
+                # rank still executes them and the graph bridge below keeps their parameters in
+                # the backward pass.
+                num_images = [pixel_values[0].shape[0]] + [0] * (len(pixel_values) - 1)
+                visual_tokens = visual_tokenizer(pixel_values[0])
+            visual_embeds, visual_input_ids = self._visual_embeds_and_ids(visual_tokens, num_images, input_device)
         else:
             # When inference, sample can include only text with `None` pixel_value
             num_images = [x.shape[0] if x is not None else 0 for x in pixel_values]
             if sum(num_images) > 0:
-                visual_tokens = self.visual_tokenizer(torch.cat([x for x in pixel_values if x is not None], dim=0))
-                visual_embeds = torch.split(self.get_vte()(visual_tokens).to(dtype=self.dtype, device=input_device),
-                                            split_size_or_sections=num_images, dim=0)
-                visual_input_ids = torch.split(torch.argmax(visual_tokens, dim=-1).to(device=input_device),
-                                               split_size_or_sections=num_images, dim=0)
-                visual_labels = [torch.full(x.shape, IGNORE_ID, dtype=torch.long, device=input_device) for x in
-                                 visual_input_ids]
+                present_pixels = tuple(x for x in pixel_values if x is not None)
+                pixel_batch = present_pixels[0] if len(present_pixels) == 1 else torch.cat(present_pixels, dim=0)
+                if text_input_ids.is_cuda:
+                    # The visual chain (tokenizer -> vte -> argmax) and the text embedding
+                    # lookup below have no data dependency; run the visual chain on a side
+                    # stream so the two overlap, and join before the scatter.
+                    side_stream = getattr(self, '_visual_side_stream', None)
+                    if side_stream is None:
+                        side_stream = torch.cuda.Stream()
+                        self._visual_side_stream = side_stream
+                    side_stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(side_stream):
+                        visual_tokens = visual_tokenizer(pixel_batch)
+                        visual_embeds, visual_input_ids = self._visual_embeds_and_ids(
+                            visual_tokens, num_images, input_device)
+                    visual_on_side_stream = True
+                else:
+                    visual_tokens = visual_tokenizer(pixel_batch)
+                    visual_embeds, visual_input_ids = self._visual_embeds_and_ids(
+                        visual_tokens, num_images, input_device)
             else:
                 # just placeholders
-                visual_embeds = [None] * len(num_images)
+                visual_embeds = None
                 visual_input_ids = [None] * len(num_images)
-                visual_labels = [None] * len(num_images)
-        # just placeholders
-        if text_labels is None:
+        # Labels are only assembled when the caller needs them: `generate` discards them,
+        # so inference skips the placeholder allocation and every label write below.
+        if text_labels is None and self.training:
+            # just placeholders
             text_labels = torch.full(text_input_ids.shape, IGNORE_ID, dtype=torch.long, device=input_device)
 
-        input_embeds = []
-        attention_masks = []
-        labels = []
-        for text_input_id, text_label, text_attention_mask, visual_embed, visual_input_id, visual_label in zip(
-                text_input_ids, text_labels, text_attention_masks, visual_embeds, visual_input_ids, visual_labels
-        ):
-            placeholder_token_mask = torch.lt(text_input_id, 0)
-            text_embed = self.get_wte()(torch.masked_fill(text_input_id, placeholder_token_mask, 0))
-            for i, indicator_id in enumerate(IMAGE_INDICATOR_IDS):
-                text_embed[text_input_id == indicator_id] = visual_indicator_embeds[i]
-            image_atom_positions = torch.where(torch.eq(text_input_id, IMAGE_ATOM_ID))[0].tolist()
-            if len(image_atom_positions) > 0:
-                input_embed_parts = []
-                attention_mask_parts = []
-                label_parts = []
-                prev_image_atom_position = -1
-                for index, image_atom_position in enumerate(image_atom_positions):
-                    input_embed_parts.append(
-                        text_embed[prev_image_atom_position + 1:image_atom_position, :])
-                    label_parts.append(
-                        text_label[prev_image_atom_position + 1:image_atom_position])
-                    attention_mask_parts.append(
-                        text_attention_mask[prev_image_atom_position + 1:image_atom_position])
-                    input_embed_parts.append(visual_embed[index])
-                    attention_mask_parts.append(
-                        torch.ones_like(visual_label[index], dtype=torch.bool))
-                    label_parts.append(visual_label[index])
-                    prev_image_atom_position = image_atom_position
-                if prev_image_atom_position + 1 < text_input_id.shape[0]:
-                    input_embed_parts.append(
-                        text_embed[prev_image_atom_position + 1:, :])
-                    attention_mask_parts.append(
-                        text_attention_mask[prev_image_atom_position + 1:])
-                    label_parts.append(
-                        text_label[prev_image_atom_position + 1:])
-                input_embed = torch.cat(input_embed_parts, dim=0)
-                attention_mask = torch.cat(attention_mask_parts, dim=0)
-                label = torch.cat(label_parts, dim=0)
-            else:
-                input_embed = text_embed
-                attention_mask = text_attention_mask
-                label = text_label
-                if self.training:
-                    # Make visual_embed & visual_indicator_embeds involved in the backward graph,
-                    # to be compatible with deepspeed zero and ddp.
-                    input_embed += torch.sum(visual_embed * 0.0) + torch.sum(visual_indicator_embeds * 0.0)
-            input_embeds.append(input_embed)
-            attention_masks.append(attention_mask)
-            labels.append(label)
-
-        batch_input_embeds = self.pad_truncate_sequence(input_embeds, batch_first=True, padding_value=0.0, left_padding=left_padding)
-        batch_attention_mask = self.pad_truncate_sequence(attention_masks, batch_first=True, padding_value=False, left_padding=left_padding)
-        batch_labels = self.pad_truncate_sequence(labels, batch_first=True, padding_value=IGNORE_ID, left_padding=left_padding)
+        batch_size, text_length = text_input_ids.shape
+        max_length = self.config.multimodal_max_length
+        placeholder_token_mask = torch.lt(text_input_ids, 0)
+        text_embeds = self.get_wte()(torch.masked_fill(text_input_ids, placeholder_token_mask, 0))
+        for i, indicator_id in enumerate(IMAGE_INDICATOR_IDS):
+            text_embeds[text_input_ids == indicator_id] = visual_indicator_embeds[i]
+
+        if visual_embeds is None:
+            # Fully-text batch: nothing to splice, only enforce the multimodal length budget.
+            window = slice(-max_length, None) if left_padding else slice(None, max_length)
+            return (visual_input_ids, text_embeds[:, window],
+                    None if text_labels is None else text_labels[:, window],
+                    text_attention_masks[:, window])
+
+        if visual_on_side_stream:
+            # Join before the scatter consumes the visual tensors; record_stream tells the
+            # caching allocator they are still in use on the current stream.
+            torch.cuda.current_stream().wait_stream(self._visual_side_stream)
+            visual_embeds.record_stream(torch.cuda.current_stream())
+            for ids in visual_input_ids:
+                ids.record_stream(torch.cuda.current_stream())
+
+        if batch_size == 1 and not self.training:
+            return self._merge_multimodal_bs1(text_embeds, text_attention_masks, text_labels,
+                                              visual_embeds, visual_input_ids, atom_mask, left_padding)
+
+        # Each image atom token expands to a constant number of visual rows, so the final
+        # column of every token is pure index arithmetic: one cumsum gives the output
+        # positions, and text/visual rows are placed with two batched scatters instead of
+        # a per-sample Python loop over slices and `torch.cat`/`pad_sequence` passes.
+        n_visual_tokens = visual_embeds.shape[1]
+        token_counts = atom_mask.long() * (n_visual_tokens - 1) + 1
+        output_lengths = token_counts.sum(dim=-1)
+        output_positions = torch.cumsum(token_counts, dim=-1) - token_counts
+        padded_length = text_length + max_atoms * (n_visual_tokens - 1)
+        # Pad only to the clipped length: tokens that fall outside the window are dropped
+        # from the scatter indices instead of being written to an oversized buffer that
+        # would immediately be sliced away.
+        output_length = min(padded_length, max_length)
+        if left_padding:
+            # Align every sample to the right edge of the clipped buffer; positions that
+            # fall before the window become negative and are filtered below.
+            output_positions = output_positions + (output_length - output_lengths).unsqueeze(-1)
+
+        batch_input_embeds = text_embeds.new_zeros((batch_size, output_length, text_embeds.shape[-1]))
+        batch_attention_mask = torch.zeros((batch_size, output_length), dtype=text_attention_masks.dtype,
+                                           device=input_device)
+        batch_labels = None if text_labels is None else \
+            torch.full((batch_size, output_length), IGNORE_ID, dtype=torch.long, device=input_device)
+
+        batch_indices = torch.arange(batch_size, device=input_device).unsqueeze(-1).expand(batch_size, text_length)
+        text_token_mask = ~atom_mask
+        text_window = text_token_mask & (output_positions >= 0) & (output_positions < output_length)
+        text_rows = batch_indices[text_window]
+        text_cols = output_positions[text_window]
+        batch_input_embeds[text_rows, text_cols] = text_embeds[text_window]
+        batch_attention_mask[text_rows, text_cols] = text_attention_masks[text_window]
+        if batch_labels is not None:
+            batch_labels[text_rows, text_cols] = text_labels[text_window]
+
+        # Map each atom to its image: samples may carry placeholder images that are never
+        # spliced, so atoms index into the flat visual embeddings via per-sample offsets.
+        image_offsets = torch.cumsum(
+            torch.tensor([0] + num_images[:-1], dtype=torch.long, device=input_device), dim=0)
+        atom_samples = batch_indices[atom_mask]
+        image_indices = image_offsets[atom_samples] + (torch.cumsum(atom_mask.long(), dim=-1) - 1)[atom_mask]
+        span_rows = atom_samples.unsqueeze(-1).expand(-1, n_visual_tokens)
+        span_cols = output_positions[atom_mask].unsqueeze(-1) + torch.arange(n_visual_tokens, device=input_device)
+        span_window = (span_cols >= 0) & (span_cols < output_length)
+        batch_input_embeds[span_rows[span_window], span_cols[span_window]] = visual_embeds[image_indices][span_window]
+        batch_attention_mask[span_rows[span_window], span_cols[span_window]] = 1
+
+        if self.training:
+            # Make visual_embeds & visual_indicator_embeds involved in the backward graph even
+            # when some (placeholder) images are never spliced, to be compatible with deepspeed
+            # zero and ddp. Touching a single element is enough to keep the producing
+            # parameters in the graph, without the former O(N_img * hidden) mul + reduce.
+            batch_input_embeds = batch_input_embeds \
+                + visual_embeds.reshape(-1)[:1].sum() * 0.0 + visual_indicator_embeds.reshape(-1)[:1].sum() * 0.0
 
         return visual_input_ids, batch_input_embeds, batch_labels, batch_attention_mask
 
+    def _merge_multimodal_bs1(self, text_embeds, text_attention_masks, text_labels,
+                              visual_embeds, visual_input_ids, atom_mask, left_padding):
+        # Specialized inference path for batch size 1: with a single sample there is no
+        # padding, so each stream is expanded with one `repeat_interleave` and the visual
+        # rows are written straight into their spans - no batched scatter, no padded
+        # buffers, no position filtering.
+        input_device = text_embeds.device
+        max_length = self.config.multimodal_max_length
+        n_visual_tokens = visual_embeds.shape[1]
+        atoms = atom_mask[0]
+        token_counts = atoms.long() * (n_visual_tokens - 1) + 1
+        span_starts = (torch.cumsum(token_counts, dim=0) - token_counts)[atoms]
+        span_positions = (span_starts.unsqueeze(-1)
+                          + torch.arange(n_visual_tokens, device=input_device)).reshape(-1)
+
+        window = slice(-max_length, None) if left_padding else slice(None, max_length)
+        input_embed = torch.repeat_interleave(text_embeds[0], token_counts, dim=0)
+        input_embed[span_positions] = visual_embeds[:span_starts.shape[0]].reshape(-1, visual_embeds.shape[-1])
+        attention_mask = torch.repeat_interleave(text_attention_masks[0].masked_fill(atoms, 1), token_counts)
+        labels = None
+        if text_labels is not None:
+            labels = torch.repeat_interleave(text_labels[0].masked_fill(atoms, IGNORE_ID), token_counts)
+            labels = labels[window].unsqueeze(0)
+        return visual_input_ids, input_embed[window].unsqueeze(0), labels, attention_mask[window].unsqueeze(0)
+
     def pad_truncate_sequence(self, sequences: List[torch.Tensor], batch_first: bool = True, padding_value: float = 0.0, left_padding: bool = False) -> torch.Tensor:
-        if not left_padding:
-            pad_sequence = torch.nn.utils.rnn.pad_sequence(sequences, batch_first=batch_first, padding_value=padding_value)
-            return pad_sequence[:,:self.config.multimodal_max_length]
-        else:
-            pad_sequence = torch.nn.utils.rnn.pad_sequence([i.flip(dims=[0]) for i in sequences],batch_first=True, padding_value=padding_value).flip(dims=[1])
-            return pad_sequence[:,-self.config.multimodal_max_length:]
+        # Allocate the clipped output once and copy each sequence into its final slice,
+        # instead of `pad_sequence` padding to the global max length (plus a flip pass for
+        # left padding) only to slice the result down to `multimodal_max_length`.
+        max_length = min(max(sequence.shape[0] for sequence in sequences), self.config.multimodal_max_length)
+        output = sequences[0].new_full((len(sequences), max_length, *sequences[0].shape[1:]), padding_value)
+        for i, sequence in enumerate(sequences):
+            length = min(sequence.shape[0], max_length)
+            if left_padding:
+                output[i, max_length - length:] = sequence[sequence.shape[0] - length:]
+            else:
+                output[i, :length] = sequence[:length]
+        return output if batch_first else output.transpose(0, 1)
 
     def preprocess_inputs(
         self,
@@ -371,7 +541,12 @@ class Ovis(OvisPreTrainedModel):
         # self.get_visual_tokenizer().get_image_processor().save_pretrained(visual_tokenizer_directory)
 
     def _get_hybrid_cache_for_llm(self, batch_size: int, max_cache_len: int):
-        cache_cls = HybridCache
+        return self._get_cache_for_llm(HybridCache, batch_size, max_cache_len)
+
+    def _get_static_cache_for_llm(self, batch_size: int, max_cache_len: int):
+        return self._get_cache_for_llm(StaticCache, batch_size, max_cache_len)
+
+    def _get_cache_for_llm(self, cache_cls, batch_size: int, max_cache_len: int):
         llm = self.get_llm()
 
         if version.parse(transformers.__version__) >= version.parse("4.46.0"):
@@ -433,7 +608,30 @@ class Ovis(OvisPreTrainedModel):
                 getattr(kwargs, "num_beams", inputs_embeds.shape[0]), kwargs['max_new_tokens'] + inputs_embeds.shape[-2])
             self.get_llm()._supports_cache_class = True
             kwargs['cache_implementation'] = None
+        elif (kwargs.get('past_key_values') is None
+              and kwargs.get('cache_implementation') is None
+              and kwargs.get('max_new_tokens') is not None
+              and getattr(self.get_llm(), '_supports_static_cache', False)):
+            # Default decode path: a preallocated static cache avoids the per-step
+            # reallocation of the dynamic cache and keeps the step graph capturable
+            # (CUDA graphs / torch.compile reduce-overhead).
+            kwargs['past_key_values'] = self._get_static_cache_for_llm(
+                kwargs.get('num_beams', 1) * inputs_embeds.shape[0],
+                kwargs['max_new_tokens'] + inputs_embeds.shape[-2])
+            self.get_llm()._supports_cache_class = True
+            kwargs['cache_implementation'] = None
 
+        if inputs_embeds.is_cuda and getattr(self.llm.config, '_attn_implementation', None) == 'sdpa':
+            # Large prefills are compute-bound and benefit from the flash kernel; short
+            # prompts and the per-token decode steps avoid its launch overhead with the
+            # efficient kernel (math kept as a general fallback).
+            if inputs_embeds.shape[-2] > 1024:
+                backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+            else:
+                backends = [SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+            with sdpa_kernel(backends):
+                return self.llm.generate(inputs=None, inputs_embeds=inputs_embeds,
+                                         attention_mask=attention_mask, **kwargs)
         return self.llm.generate(inputs=None, inputs_embeds=inputs_embeds, attention_mask=attention_mask, **kwargs)
 
 
@@ -17,11 +17,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List, Union
 
+import numpy as np
 import PIL
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from transformers import BatchFeature
 from transformers.image_utils import ImageInput
 from transformers.processing_utils import ProcessingKwargs, ProcessorMixin, Unpack
@@ -30,6 +33,113 @@ from transformers.tokenization_utils_base import TextInput, PreTokenizedInput
 __all__ = [ 'OvisProcessor']
 IGNORE_ID = -100
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _scalar_covering_area(w, h, side):
+    long_edge = w if w >= h else h
+    if long_edge > side:
+        scale = side / long_edge
+        return w * h * scale * scale
+    return float(w * h)
+
+
+def _grid_search(w, h, max_partition, covering_threshold, side):
+    # Scalar twin of the NumPy search in _get_best_grid, written with plain
+    # ints and floats so numba can compile it; the candidate grids are too
+    # small (<= max_partition entries) for NumPy dispatch overhead to pay off.
+    # Iteration order and tie-breaking match the vectorized path exactly.
+    best_i = 1
+    best_j = 1
+    best_cells = max_partition + 1
+    best_ratio = -1.0
+    found_good = False
+    img_area = float(w * h)
+    for i in range(1, max_partition + 1):
+        for j in range(1, max_partition + 1):
+            if i * j > max_partition:
+                continue
+            row_h = h // i
+            col_w = w // j
+            last_h = h - (i - 1) * row_h
+            last_w = w - (j - 1) * col_w
+            area = ((i - 1) * (j - 1) * _scalar_covering_area(col_w, row_h, side)
+                    + (i - 1) * _scalar_covering_area(last_w, row_h, side)
+                    + (j - 1) * _scalar_covering_area(col_w, last_h, side)
+                    + _scalar_covering_area(last_w, last_h, side))
+            ratio = area / img_area
+            cells = i * j
+            if ratio > covering_threshold:
+                if not found_good or cells < best_cells or (cells == best_cells and ratio > best_ratio):
+                    found_good = True
+                    best_i, best_j, best_cells, best_ratio = i, j, cells, ratio
+            elif not found_good:
+                if ratio > best_ratio or (ratio == best_ratio and cells < best_cells):
+                    best_i, best_j, best_cells, best_ratio = i, j, cells, ratio
+    return best_i, best_j
+
+
+if njit is not None:
+    _scalar_covering_area = njit(cache=True)(_scalar_covering_area)
+    _grid_search = njit(cache=True)(_grid_search)
+else:
+    _grid_search = None
+
+
+def _covering_area(w, h, side):
+    # the long edge is clamped to `side` and the short edge scaled by the
+    # same factor, so the area shrinks by min(side / long_edge, 1)^2
+    scale = np.minimum(side / np.maximum(w, h), 1.0)
+    return w * h * scale * scale
+
+
+@lru_cache(maxsize=1024)
+def _get_best_grid(w, h, max_partition, covering_threshold, side):
+    # The optimal grid depends only on the image size and the config knobs, so
+    # results are memoized; serving workloads repeat a handful of resolutions.
+    if w <= side and h <= side:
+        # nothing is clamped, so (1, 1) covers fully with the fewest sub-images
+        return 1, 1
+
+    if _grid_search is not None:
+        return _grid_search(w, h, max_partition, covering_threshold, side)
+
+    img_area = w * h
+
+    # Score every candidate grid at once. A grid's cells fall into four
+    # archetypes (interior, last column, last row, corner), so the total
+    # covering area is a closed-form broadcast over all (rows, cols)
+    # pairs instead of a per-cell Python loop.
+    i, j = np.meshgrid(np.arange(1, max_partition + 1),
+                       np.arange(1, max_partition + 1), indexing='ij')
+    valid = (i * j) <= max_partition
+    i, j = i[valid], j[valid]
+
+    row_h = h // i
+    col_w = w // j
+    last_h = h - (i - 1) * row_h
+    last_w = w - (j - 1) * col_w
+
+    covering_ratio = ((i - 1) * (j - 1) * _covering_area(col_w, row_h, side)
+                      + (i - 1) * _covering_area(last_w, row_h, side)
+                      + (j - 1) * _covering_area(col_w, last_h, side)
+                      + _covering_area(last_w, last_h, side)) / img_area
+    assert covering_ratio.max() <= 1.0
+
+    num_cells = i * j
+    good = covering_ratio > covering_threshold
+    if good.any():
+        # pick the good partition with minimum #sub_images and break the tie using covering_ratio
+        order = np.lexsort((-covering_ratio[good], num_cells[good]))
+        best = np.flatnonzero(good)[order[0]]
+    else:
+        # pick the partition with maximum covering_ratio and break the tie using #sub_images
+        best = np.lexsort((num_cells, -covering_ratio))[0]
+    return int(i[best]), int(j[best])
+
 class OvisProcessorKwargs(ProcessingKwargs, total=False):
     _defaults = {
         "text_kwargs": {
@@ -39,6 +149,8 @@ class OvisProcessorKwargs(ProcessingKwargs, total=False):
             'max_partition':9,
             'covering_threshold':0.9,
             'convert_to_rgb':True,
+            'pin_memory':False,
+            'num_proc':1,
         'return_tensors':'pt'},
     }
 
@@ -68,6 +180,19 @@ class OvisProcessor(ProcessorMixin):
         self.image_token = "<|image_pad|>" if not hasattr(tokenizer, "image_token") else tokenizer.image_token
         self.video_token = "<|video_pad|>" if not hasattr(tokenizer, "video_token") else tokenizer.video_token
         super().__init__(image_processor, tokenizer, chat_template=chat_template)
+        # Special token ids are resolved once here, via the direct vocab lookup
+        # rather than a full encode pass, instead of once per grid cell in
+        # `construct_image_placeholders` and once per batch in `__call__`.
+        self._special_token_ids = {
+            name: self.tokenizer.convert_tokens_to_ids(token)
+            for name, token in self.tokenizer.extra_special_tokens.items()
+        }
+        # Normalization constants as broadcastable tensors, built once instead of
+        # per crop on the fused preprocessing path.
+        image_mean = getattr(self.image_processor, 'image_mean', None)
+        image_std = getattr(self.image_processor, 'image_std', None)
+        self._image_mean_tensor = None if image_mean is None else torch.tensor(image_mean).view(3, 1, 1)
+        self._image_std_tensor = None if image_std is None else torch.tensor(image_std).view(3, 1, 1)
 
     def __call__(
         self,
@@ -103,6 +228,8 @@ class OvisProcessor(ProcessorMixin):
                 [`BatchFeature`]: A [`BatchFeature`] with the following fields:
 
                 - **input_ids** -- List of token ids to be fed to a model. Returned when `text` is not `None`.
+                  Sequences are right-padded with the tokenizer's pad token to the longest sequence in the
+                  batch after image-placeholder expansion.
                 - **attention_mask** -- List of indices specifying which tokens should be attended to by the model (when
                   `return_attention_mask=True` or if *"attention_mask"* is in `self.model_input_names` and if `text` is not
                   `None`).
@@ -117,22 +244,33 @@ class OvisProcessor(ProcessorMixin):
             tokenizer_init_kwargs=self.tokenizer.init_kwargs,
             **kwargs,
         )
+        # Page-locked output tensors let the caller's .to(device, non_blocking=True)
+        # overlap the host-to-device copy with compute.
+        pin_memory = output_kwargs["images_kwargs"].pop("pin_memory", False) and torch.cuda.is_available()
+        num_proc = output_kwargs["images_kwargs"].pop("num_proc", 1)
 
         # Process all images first
         image_features = {}
         if images is not None:
-            processed_images = []
-            image_placeholders_list = []
-            grids = []
-
-            # Process each image
-            for image in images if isinstance(images, list) else [images]:
-                pixel_values, image_placeholders, grid = self.preprocess_image(
-                    image=image, **output_kwargs["images_kwargs"]
-                )
-                processed_images.append(pixel_values)
-                image_placeholders_list.append(image_placeholders)
-                grids.append(grid)
+            # Process each image; preprocessing is CPU-bound and releases the GIL
+            # inside PIL/NumPy/torch ops, so a thread pool scales on multi-image
+            # batches when num_proc > 1.
+            images = images if isinstance(images, list) else [images]
+            if num_proc > 1 and len(images) > 1:
+                with ThreadPoolExecutor(min(num_proc, len(images))) as pool:
+                    results = list(pool.map(
+                        lambda image: self.preprocess_image(image=image, **output_kwargs["images_kwargs"]),
+                        images))
+            else:
+                results = [self.preprocess_image(image=image, **output_kwargs["images_kwargs"])
+                           for image in images]
+            if results:
+                processed_images, image_placeholders_list, grids = (list(column) for column in zip(*results))
+            else:
+                processed_images, image_placeholders_list, grids = [], [], []
+
+            if pin_memory:
+                processed_images = [pixel_values.pin_memory() for pixel_values in processed_images]
 
             # assign all processed images
             if processed_images:
@@ -144,38 +282,55 @@ class OvisProcessor(ProcessorMixin):
             if not isinstance(text, list):
                 text = [text]
 
+            if "image_placeholders" in image_features:
+                # Substitute the placeholder token string into the raw text so the
+                # fast tokenizer emits the expanded ids in one pass; when a decoded
+                # placeholder does not round-trip, keep the id-level splice below.
+                inlined = self._try_inline_placeholders(text, image_features["image_placeholders"])
+                if inlined is not None:
+                    text = inlined
+
             tokenized_batched_text = self.tokenizer.batch_encode_plus(
                 text,
                 **output_kwargs["text_kwargs"]
             )
-            image_token_id = self.tokenizer(self.tokenizer.extra_special_tokens['image_token'])['input_ids'][0]
+            image_token_id = self._special_token_ids['image_token']
+            # Pre-build one tensor per image so the splice below works on tensor views.
+            if "image_placeholders" in image_features:
+                # from_numpy over a typed array converts the id list in C and
+                # wraps the buffer without a per-element Python copy
+                placeholder_tensors = [torch.from_numpy(np.asarray(p, dtype=np.int64))
+                                       for p in image_features["image_placeholders"]]
             replaced_ids_list = []
             replaced_attn_mask_list = []
             idx = 0
+            has_images = "image_placeholders" in image_features
             for ids_tensor, attn_mask in zip(tokenized_batched_text['input_ids'],
                                              tokenized_batched_text['attention_mask']):
-                if image_token_id in ids_tensor and "image_placeholders" in image_features:
+                # One vectorized comparison both gates the splice (text-only
+                # samples skip it entirely) and provides the splice positions.
+                token_mask = (ids_tensor == image_token_id) if has_images else None
+                if token_mask is not None and bool(token_mask.any()):
                     if idx < len(image_features["image_placeholders"]):
-                        # Converts in list for ease of use
-                        ids_list = ids_tensor.tolist()
-                        attn_list = attn_mask.tolist()
-                        placeholder_ids = image_features["image_placeholders"][idx]
+                        placeholder_ids = placeholder_tensors[idx]
+                        placeholder_attn = torch.ones(len(placeholder_ids), dtype=torch.long)
 
+                        # Splice the placeholder in at each image-token position using
+                        # slice views and a single concatenation, instead of walking the
+                        # sequence token-by-token in Python.
+                        positions = token_mask.nonzero(as_tuple=True)[0].tolist()
                         new_ids = []
                         new_attn = []
-
-                        # replace placeholders
-                        for i, token_id in enumerate(ids_list):
-                            if token_id == image_token_id:
-                                new_ids.extend(placeholder_ids)
-                                new_attn.extend([1] * len(placeholder_ids))
-                            else:
-                                new_ids.append(token_id)
-                                new_attn.append(attn_list[i])
-
-                        # Converts back to tensors
-                        ids_tensor = torch.tensor(new_ids, dtype=torch.long)
-                        attn_mask = torch.tensor(new_attn, dtype=torch.long)
+                        prev = 0
+                        for pos in positions:
+                            new_ids.extend((ids_tensor[prev:pos], placeholder_ids))
+                            new_attn.extend((attn_mask[prev:pos], placeholder_attn))
+                            prev = pos + 1
+                        new_ids.append(ids_tensor[prev:])
+                        new_attn.append(attn_mask[prev:])
+
+                        ids_tensor = torch.cat(new_ids)
+                        attn_mask = torch.cat(new_attn)
                         idx += 1
                     else:
                         raise RuntimeError(
@@ -185,8 +340,15 @@ class OvisProcessor(ProcessorMixin):
                 replaced_attn_mask_list.append(attn_mask)
 
             if replaced_ids_list:
-                replaced_and_tokenized_ids = torch.stack(replaced_ids_list)
-                replaced_and_tokenized_attn_mask = torch.stack(replaced_attn_mask_list)
+                # Placeholder expansion makes the sequences ragged (each image grid has
+                # its own placeholder length), so stack would raise; right-pad instead.
+                replaced_and_tokenized_ids = pad_sequence(
+                    replaced_ids_list, batch_first=True, padding_value=self.tokenizer.pad_token_id)
+                replaced_and_tokenized_attn_mask = pad_sequence(
+                    replaced_attn_mask_list, batch_first=True, padding_value=0)
+                if pin_memory:
+                    replaced_and_tokenized_ids = replaced_and_tokenized_ids.pin_memory()
+                    replaced_and_tokenized_attn_mask = replaced_and_tokenized_attn_mask.pin_memory()
             else:
                 replaced_and_tokenized_ids = torch.tensor([], dtype=torch.long)
                 replaced_and_tokenized_attn_mask = torch.tensor([], dtype=torch.long)
@@ -211,13 +373,42 @@ class OvisProcessor(ProcessorMixin):
         return BatchFeature(data=image_features)
 
 
+    def _try_inline_placeholders(self, texts, image_placeholders_list):
+        """Rewrite each image token in `texts` as its placeholder token string.
+
+        The fast tokenizer then produces the expanded ids in a single pass with
+        no id-level post-processing. Returns the rewritten texts, or `None` when
+        a decoded placeholder does not round-trip through the tokenizer, in
+        which case the caller falls back to splicing the ids directly.
+        """
+        image_token = self.tokenizer.extra_special_tokens.get('image_token', self.image_token)
+        decoded = {}
+        rewritten = []
+        idx = 0
+        for sample in texts:
+            if image_token in sample:
+                if idx >= len(image_placeholders_list):
+                    raise RuntimeError(
+                        'Mismatch between the images you provided and the number of placeholder present in the text')
+                placeholder_ids = image_placeholders_list[idx]
+                key = tuple(placeholder_ids)
+                if key not in decoded:
+                    placeholder_str = self.tokenizer.decode(placeholder_ids)
+                    if self.tokenizer(placeholder_str, add_special_tokens=False)['input_ids'] != list(placeholder_ids):
+                        return None
+                    decoded[key] = placeholder_str
+                sample = sample.replace(image_token, decoded[key])
+                idx += 1
+            rewritten.append(sample)
+        return rewritten
+
     def get_image_size(self):
         height = self.image_processor.crop_size["height"]
         width = self.image_processor.crop_size["width"]
         return height, width
 
     def get_token_value(self, tok):
-            return self.tokenizer(self.tokenizer.extra_special_tokens[tok])["input_ids"][0]
+            return self._special_token_ids[tok]
 
     def construct_image_placeholders(self, grid):
 
@@ -225,42 +416,93 @@ class OvisProcessor(ProcessorMixin):
                               self.get_token_value('image_atom'),
                               self.get_token_value('image_prefix')]
         if grid[0] * grid[1] > 1:
-            for r in range(grid[0]):
-                for c in range(grid[1]):
-                    image_placeholders.append(self.get_token_value('image_atom') )
-                    if c < grid[1] - 1:
-                        image_placeholders.append(self.get_token_value('image_col_sep'))
-                if r < grid[0] - 1:
-                    image_placeholders.append(self.get_token_value('image_row_sep'))
+            # Build one row with list multiplication and repeat it per grid row: the work
+            # happens in C-implemented list ops instead of a nested Python loop.
+            row = [self.get_token_value('image_atom'), self.get_token_value('image_col_sep')] * (grid[1] - 1) \
+                + [self.get_token_value('image_atom')]
+            image_placeholders += row + ([self.get_token_value('image_row_sep')] + row) * (grid[0] - 1)
         image_placeholders.append(self.get_token_value('image_end'))
         return image_placeholders
 
     def preprocess_image(self, image: PIL.Image.Image, max_partition, covering_threshold, convert_to_rgb, return_tensors):
-        def _preprocess(img: PIL.Image.Image, side):
-            # first resize and preprocess
-            w, h = img.size
+        def _crop_size(crop):
+            if isinstance(crop, np.ndarray):
+                return crop.shape[1], crop.shape[0]
+            return crop.size
+
+        def _resized_size(crop, side):
+            # aspect-preserving resize with the longer edge mapped to `side`
+            w, h = _crop_size(crop)
             if w == h:
-                new_width = new_height = side
-            elif w > h:
-                new_width = side
-                new_height = int(h / w * new_width)
-            else:
-                new_height = side
-                new_width = int(w / h * new_height)
-            new_size = dict(height=new_height, width=new_width)
-            pixel_values = self.image_processor.preprocess(img, size=new_size, return_tensors=return_tensors)['pixel_values']
-
-            # then pad to square
-            square_values = torch.zeros([1, 3, side, side], dtype=pixel_values.dtype, device=pixel_values.device)
-            new_height, new_width = pixel_values.shape[2:]
+                return side, side
+            if w > h:
+                return int(h / w * side), side
+            return side, int(w / h * side)
+
+        def _write_square(pixel_values, out):
+            # center an aspect-preserving resized crop into a zeroed square slice
+            side = out.shape[-1]
+            new_height, new_width = pixel_values.shape[1:]
             if new_height == new_width:
-                square_values[:, :, :, :] = pixel_values
+                out[:, :, :] = pixel_values
             elif new_height > new_width:
                 from_index = (side - new_width) // 2
-                square_values[:, :, :, from_index:from_index + new_width] = pixel_values
+                out[:, :, from_index:from_index + new_width] = pixel_values
             else:
                 from_index = (side - new_height) // 2
-                square_values[:, :, from_index:from_index + new_height, :] = pixel_values
+                out[:, from_index:from_index + new_height, :] = pixel_values
+
+        def _fused_preprocess(crops, sizes, side):
+            # Resize with PIL, then rescale/normalize/permute in one chained pass
+            # written straight into the padded square buffer. This skips the HF
+            # pipeline's intermediate buffers on a memory-bound path.
+            processor = self.image_processor
+            mean = self._image_mean_tensor
+            std = self._image_std_tensor
+            square_values = torch.zeros((len(crops), 3, side, side))
+            for index, (crop, (new_height, new_width)) in enumerate(zip(crops, sizes)):
+                img = PIL.Image.fromarray(crop) if isinstance(crop, np.ndarray) else crop
+                arr = np.asarray(img.resize((new_width, new_height), processor.resample))
+                values = torch.from_numpy(arr).permute(2, 0, 1).to(torch.float32)
+                values.mul_(processor.rescale_factor).sub_(mean).div_(std)
+                _write_square(values, square_values[index])
+            return square_values
+
+        def _preprocess(crops, side):
+            sizes = [_resized_size(crop, side) for crop in crops]
+
+            # The fused path covers the plain resize+rescale+normalize pipeline;
+            # anything fancier falls back to the image processor itself.
+            processor = self.image_processor
+            if (return_tensors == 'pt'
+                    and getattr(processor, 'do_resize', False)
+                    and getattr(processor, 'do_rescale', False)
+                    and getattr(processor, 'do_normalize', False)
+                    and not getattr(processor, 'do_center_crop', False)
+                    and self._image_mean_tensor is not None
+                    and self._image_std_tensor is not None):
+                return _fused_preprocess(crops, sizes, side)
+
+            # Crops that resize to the same (height, width) go through the HF
+            # preprocessing pipeline in one batched call; its per-call overhead
+            # is otherwise paid once per crop.
+            groups = {}
+            for i, size in enumerate(sizes):
+                groups.setdefault(size, []).append(i)
+
+            square_values = None
+            for (new_height, new_width), indices in groups.items():
+                batch = self.image_processor.preprocess(
+                    [crops[i] for i in indices],
+                    size=dict(height=new_height, width=new_width),
+                    return_tensors=return_tensors)['pixel_values']
+                if square_values is None:
+                    # One buffer holds every padded crop; each preprocessed crop is
+                    # written straight into its slice, so there is no per-crop
+                    # allocation and no trailing torch.cat.
+                    square_values = batch.new_zeros((len(crops), 3, side, side))
+                for i, value in zip(indices, batch):
+                    _write_square(value, square_values[i])
 
             return square_values
 
@@ -280,41 +522,6 @@ class OvisProcessor(ProcessorMixin):
 
             return partition
 
-        def _covering_area(left, upper, right, lower, side):
-            w = right - left
-            h = lower - upper
-            w, h = max(w, h), min(w, h)
-            if w > side:
-                h = h / w * side
-                w = side
-            return w * h
-
-        def _get_best_grid(img, side):
-            img_area = img.size[0] * img.size[1]
-
-            candidate_grids = []
-            for i in range(1, max_partition + 1):
-                for j in range(1, max_partition + 1):
-                    if i * j <= max_partition:
-                        candidate_grids.append((i, j))
-
-            all_grids = []
-            good_grids = []
-            for grid in candidate_grids:
-                partition = _partition(img, grid)
-                covering_ratio = sum([_covering_area(*p, side) for p in partition]) / img_area
-                assert covering_ratio <= 1.0
-                all_grids.append((grid, covering_ratio))
-                if covering_ratio > covering_threshold:
-                    good_grids.append((grid, covering_ratio))
-
-            if len(good_grids) > 0:
-                # pick the good partition with minimum #sub_images and break the tie using covering_ratio
-                return sorted(good_grids, key=lambda x: (x[0][0] * x[0][1], -x[1]))[0][0]
-            else:
-                # pick the partition with maximum covering_ratio and break the tie using #sub_images
-                return sorted(all_grids, key=lambda x: (-x[1], x[0][0] * x[0][1]))[0][0]
-
         if convert_to_rgb and image.mode != 'RGB':
             image = image.convert('RGB')
 
@@ -323,12 +530,17 @@ class OvisProcessor(ProcessorMixin):
         if sides[0] != sides[1]:
             raise ValueError('get_image_size() returns non-square size')
         side = sides[0]
-        grid = _get_best_grid(image, side)
+        grid = _get_best_grid(*image.size, max_partition, covering_threshold, side)
         partition = _partition(image, grid)
-        crops = [image.crop(p) for p in partition]
-        if len(crops) > 1:
-            crops.insert(0, image)
-        pixel_values = torch.cat([_preprocess(crop, side) for crop in crops], dim=0)
+        if len(partition) > 1:
+            # Slice the pixel data once as a NumPy array: each crop becomes a
+            # zero-copy view instead of a PIL crop that duplicates its pixels.
+            arr = np.asarray(image)
+            crops = [image] + [arr[upper:lower, left:right]
+                               for left, upper, right, lower in partition]
+        else:
+            crops = [image]
+        pixel_values = _preprocess(crops, side)
         image_placeholders = self.construct_image_placeholders(grid)
         return pixel_values, image_placeholders, grid
 